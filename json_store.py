@@ -0,0 +1,24 @@
+import os
+import orjson
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'zotero-ai-note-taker')
+
+def load_json(path):
+    """Returns the JSON object stored at path, or {} if it is missing or unreadable."""
+    try:
+        with open(path, 'rb') as f:
+            data = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def save_json(path, data):
+    """Writes data to path atomically; a failed write only costs a cache miss later."""
+    tmp_path = path + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
@@ -1,8 +1,18 @@
 import sys
 import os
-import json
-import markdown
-import bibtexparser
+import orjson
+import time
+import asyncio
+import contextlib
+import shutil
+import tempfile
+import threading
+import functools
+from collections import defaultdict
+from dataclasses import dataclass, fields, asdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 from bibtexparser.bwriter import BibTexWriter
 
 from PyQt6.QtWidgets import (
@@ -14,8 +24,14 @@ from PyQt6.QtWidgets import (
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
 from PyQt6.QtGui import QStandardItemModel, QStandardItem, QColor, QAction
 
+import httpx
 from pyzotero import zotero
-import google.genai as genai
+from aiolimiter import AsyncLimiter
+# google.genai and markdown are slow to import and only needed by SummaryWorker,
+# so they are imported where they are used to keep startup fast.
+
+from zotero_cache import CachedZotero
+from pdf_cache import PdfCache, file_sha256
 
 # ==============================================================================
 #  NEW: SETTINGS MANAGEMENT
@@ -32,18 +48,54 @@ DEFAULT_SETTINGS = {
 """
 }
 
+class SettingsError(ValueError):
+    """Raised when settings.json holds values that don't fit the settings schema."""
+
+@dataclass(frozen=True)
+class Settings:
+    """Application settings, validated once when they are created."""
+    zotero_library_id: str
+    zotero_library_type: str
+    zotero_api_key: str
+    gemini_api_key: str
+    gemini_system_prompt: str
+
+    def __post_init__(self):
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if not isinstance(value, str):
+                raise SettingsError(f"Setting '{field.name}' must be text, not {type(value).__name__}.")
+        if self.zotero_library_type not in ("user", "group"):
+            raise SettingsError(f"Setting 'zotero_library_type' must be 'user' or 'group', not '{self.zotero_library_type}'.")
+
+    def unconfigured_fields(self):
+        """Returns the names of settings still holding a 'YOUR_...' placeholder."""
+        return [field.name for field in fields(self) if "YOUR_" in getattr(self, field.name)]
+
 def load_settings():
-    """Loads settings from the JSON file."""
+    """Loads settings from the JSON file, layered over DEFAULT_SETTINGS. Raises SettingsError if invalid."""
     try:
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return DEFAULT_SETTINGS.copy()
+        with open(CONFIG_FILE, 'rb') as f:
+            overrides = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        overrides = {}
+    if not isinstance(overrides, dict):
+        raise SettingsError(f"{CONFIG_FILE} must contain a JSON object.")
+    known_keys = {field.name for field in fields(Settings)}
+    return Settings(**{**DEFAULT_SETTINGS, **{k: v for k, v in overrides.items() if k in known_keys}})
 
-def save_settings(settings_dict):
-    """Saves settings to the JSON file."""
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(settings_dict, f, indent=4)
+def save_settings(settings):
+    """Saves the settings that differ from DEFAULT_SETTINGS to the JSON file.
+
+    Only overrides are stored, so changes to the defaults (e.g. a new default
+    prompt) reach existing users. The write is atomic so a crash can't leave
+    the file half-written.
+    """
+    overrides = {k: v for k, v in asdict(settings).items() if DEFAULT_SETTINGS.get(k) != v}
+    tmp_file = CONFIG_FILE + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(orjson.dumps(overrides, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_file, CONFIG_FILE)
 
 # ==============================================================================
 #  NEW: SETTINGS DIALOG WINDOW
@@ -57,15 +109,18 @@ class SettingsDialog(QDialog):
         self.layout = QVBoxLayout(self)
         form_layout = QFormLayout()
 
-        self.library_id_edit = QLineEdit(current_settings.get("zotero_library_id"))
+        self.library_id_edit = QLineEdit(current_settings.zotero_library_id)
         self.library_type_combo = QComboBox()
         self.library_type_combo.addItems(["user", "group"])
-        self.library_type_combo.setCurrentText(current_settings.get("zotero_library_type", "user"))
-        self.zotero_key_edit = QLineEdit(current_settings.get("zotero_api_key"))
+        self.library_type_combo.setCurrentText(current_settings.zotero_library_type)
+        self.zotero_key_edit = QLineEdit(current_settings.zotero_api_key)
         self.zotero_key_edit.setEchoMode(QLineEdit.EchoMode.Password)
-        self.gemini_key_edit = QLineEdit(current_settings.get("gemini_api_key"))
+        self.gemini_key_edit = QLineEdit(current_settings.gemini_api_key)
         self.gemini_key_edit.setEchoMode(QLineEdit.EchoMode.Password)
-        self.prompt_edit = QTextEdit(current_settings.get("gemini_system_prompt"))
+        # setPlainText, not the constructor: QTextEdit(str) parses HTML and would
+        # collapse the prompt's newlines, so it would never compare equal to the default.
+        self.prompt_edit = QTextEdit()
+        self.prompt_edit.setPlainText(current_settings.gemini_system_prompt)
         self.prompt_edit.setMinimumHeight(200)
 
         form_layout.addRow("Zotero Library ID:", self.library_id_edit)
@@ -82,14 +137,74 @@ class SettingsDialog(QDialog):
         self.layout.addWidget(buttons)
 
     def get_settings(self):
-        """Returns a dict of the settings from the dialog fields."""
-        return {
-            "zotero_library_id": self.library_id_edit.text(),
-            "zotero_library_type": self.library_type_combo.currentText(),
-            "zotero_api_key": self.zotero_key_edit.text(),
-            "gemini_api_key": self.gemini_key_edit.text(),
-            "gemini_system_prompt": self.prompt_edit.toPlainText()
-        }
+        """Returns the settings from the dialog fields."""
+        return Settings(
+            zotero_library_id=self.library_id_edit.text(),
+            zotero_library_type=self.library_type_combo.currentText(),
+            zotero_api_key=self.zotero_key_edit.text(),
+            gemini_api_key=self.gemini_key_edit.text(),
+            gemini_system_prompt=self.prompt_edit.toPlainText()
+        )
+
+# ==============================================================================
+#  ZOTERO ITEM HELPERS
+# ==============================================================================
+AI_SUMMARY_TAG = 'AI-Summary'
+
+def has_tag(item, tag):
+    """Returns True if the item carries the given tag, stopping at the first match."""
+    return any(t.get('tag') == tag for t in item['data'].get('tags', ()))
+
+def is_pdf_attachment(item):
+    filename = item['data'].get('filename')
+    return item['data']['itemType'] == 'attachment' and filename is not None and filename[-4:].lower() == '.pdf'
+
+def is_ai_note(item):
+    return item['data']['itemType'] == 'note' and has_tag(item, AI_SUMMARY_TAG)
+
+# ==============================================================================
+#  HTTP CLIENT
+# ==============================================================================
+# pyzotero keeps one pooled httpx client per Zotero instance; these settings
+# replace its defaults with explicit timeouts, pool sizes and retries.
+HTTP_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+HTTP_LIMITS = httpx.Limits(max_connections=16, max_keepalive_connections=4)
+
+class RetryTransport(httpx.HTTPTransport):
+    """HTTP transport that retries rate-limited and transient server errors with exponential backoff.
+
+    It also caps the connect timeout, because pyzotero passes timeout=30 on each
+    read and that replaces the client's default, connect timeout included.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, connect_timeout=HTTP_TIMEOUT.connect, **kwargs):
+        super().__init__(retries=max_retries, **kwargs) # Connection errors
+        self.max_retries, self.backoff_factor = max_retries, backoff_factor
+        self.connect_timeout = connect_timeout
+
+    def handle_request(self, request):
+        timeout = request.extensions.get('timeout', {})
+        if timeout.get('connect') is None or timeout['connect'] > self.connect_timeout:
+            request.extensions['timeout'] = {**timeout, 'connect': self.connect_timeout}
+        for attempt in range(self.max_retries + 1):
+            response = super().handle_request(request)
+            if response.status_code not in self.RETRY_STATUSES or attempt == self.max_retries:
+                return response
+            retry_after = response.headers.get('retry-after', '')
+            response.close()
+            time.sleep(float(retry_after) if retry_after.isdigit() else self.backoff_factor * 2 ** attempt)
+
+def configure_http_client(zot):
+    """Swaps a pyzotero instance's HTTP client for a tuned, retrying one and returns the instance."""
+    zot.client.close()
+    zot.client = httpx.Client(
+        headers=zot.default_headers(),
+        follow_redirects=True,
+        timeout=HTTP_TIMEOUT,
+        transport=RetryTransport(limits=HTTP_LIMITS)
+    )
+    return zot
 
 # ==============================================================================
 #  WORKER THREADS (Unchanged)
@@ -97,6 +212,23 @@ class SettingsDialog(QDialog):
 # ZoteroWorker, SummaryWorker, and CollectionSummaryWorker classes remain the same
 # as the last provided version. They are included here for completeness.
 
+# Gemini rate limiting: at most this many generate_content requests in flight,
+# and this many per rolling minute (free-tier RPM).
+MAX_CONCURRENT_SUMMARIES = 4
+GEMINI_REQUESTS_PER_MINUTE = 10
+# Rate-limited (429) and transient server errors are retried by the SDK with
+# jittered exponential backoff starting at 4s, up to 3 attempts in total.
+GEMINI_RETRY_OPTIONS = {'attempts': 3, 'initial_delay': 4.0, 'http_status_codes': [429, 500, 502, 503, 504]}
+# Papers buffered between SummaryWorker pipeline stages.
+PIPELINE_QUEUE_SIZE = 2
+# Notes are created in batches; 50 is the Zotero write API's per-request limit.
+NOTE_BATCH_SIZE = 50
+NOTE_FLUSH_INTERVAL = 10
+
+# Concurrent Zotero Web API requests when compiling a collection summary.
+ZOTERO_FETCH_WORKERS = 8
+BIBTEX_ENTRY_SEPARATOR = '\x00'
+
 class ZoteroWorker(QThread):
     finished = pyqtSignal(object)
     error = pyqtSignal(str)
@@ -112,10 +244,17 @@ class ZoteroWorker(QThread):
             elif self.task == 'fetch_items':
                 collection_key = self.args[0]
                 items = self.zot.collection_items_top(collection_key)
+                # Fetch every attachment/note in the collection in a few paginated
+                # requests (the cached client returns all pages) and group them by
+                # parent, instead of one request per item.
+                all_children = self.zot.collection_items(collection_key, itemType='attachment || note')
+                children_by_parent = defaultdict(list)
+                for child in all_children:
+                    children_by_parent[child['data'].get('parentItem')].append(child)
                 for item in items:
-                    children = self.zot.children(item['data']['key'])
-                    item['data']['has_pdf'] = any(c['data'].get('filename', '').lower().endswith('.pdf') for c in children if c['data']['itemType'] == 'attachment')
-                    item['data']['has_ai_note'] = any('AI-Summary' in [t.get('tag') for t in c['data'].get('tags', [])] for c in children if c['data']['itemType'] == 'note')
+                    children = children_by_parent.get(item['data']['key'], [])
+                    item['data']['has_pdf'] = any(is_pdf_attachment(c) for c in children)
+                    item['data']['has_ai_note'] = any(is_ai_note(c) for c in children)
                 data = items
             else: data = None
             self.finished.emit(data)
@@ -135,82 +274,304 @@ class SummaryWorker(QThread):
         self.papers, self.model, self.temperature = papers_to_process, model, temperature
         self.system_prompt = system_prompt
         self.is_running = True
+        self._zotero_executor, self._markdown_executor = None, None
+        self.pdf_cache, self._markdown = None, None
 
     def run(self):
+        import google.genai as genai
         try:
-            client = genai.Client()
+            client = genai.Client(http_options=genai.types.HttpOptions(
+                retry_options=genai.types.HttpRetryOptions(**GEMINI_RETRY_OPTIONS)
+            ))
         except Exception as e:
             self.error.emit(f"Failed to configure Gemini model: {e}")
             return
 
-        for i, paper_data in enumerate(self.papers):
-            if not self.is_running:
-                break
-            
-            row, item = paper_data['row'], paper_data['item']
-            item_key, item_title = item['data']['key'], item['data'].get('title', 'Untitled')
+        try:
+            asyncio.run(self._process_all(client))
+        except Exception as e:
+            self.error.emit(f"Summary generation failed: {e}")
 
-            self.progress.emit(f"Processing '{item_title}'...")
-            self.paper_finished.emit(row, "Summarizing...")
+        self.all_finished.emit()
 
+    async def _process_all(self, client):
+        """Summarizes all papers in a three-stage pipeline: prepare -> generate -> create note.
+
+        Stages are connected by small bounded queues, so the next paper's PDF is located
+        and uploaded while earlier papers are still waiting on Gemini, without letting
+        preparation run arbitrarily far ahead.
+        """
+        import markdown
+        self.pdf_cache = PdfCache(os.environ.get('GEMINI_API_KEY', ''))
+        self._markdown = markdown.Markdown(extensions=['fenced_code', 'tables', 'sane_lists'])
+        limiter = AsyncLimiter(GEMINI_REQUESTS_PER_MINUTE, 60)
+        prepared = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        generated = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        # pyzotero clients keep per-request state and are not thread-safe,
+        # so every blocking Zotero call goes through a single worker thread.
+        # The shared Markdown converter isn't thread-safe either, so it gets its own.
+        with ThreadPoolExecutor(max_workers=1) as executor, ThreadPoolExecutor(max_workers=1) as markdown_executor:
+            self._zotero_executor, self._markdown_executor = executor, markdown_executor
             try:
-                self.progress.emit("  -> Searching for local PDF via Zotero server...")
-                children = self.zot_local.children(item_key)
-                pdf_child = next((c for c in children if c['data']['itemType'] == 'attachment' and c['data'].get('filename', '').lower().endswith('.pdf')), None)
-
-                if not pdf_child:
-                    self.paper_finished.emit(row, "Error: PDF not found")
-                    self.progress.emit(f"  -> Could not find a local PDF for '{item_title}'.")
-                    continue
-                
-                pdf_key = pdf_child['data']['key']
-                self.progress.emit(f"  -> Found local PDF. Downloading from Zotero server...")
-                pdf_bytes = self.zot_local.file(pdf_key)
-
-                response = client.models.generate_content(
-                    model=self.model,
-                    contents=[
-                        "Please analyze the provided research paper and generate notes according to the system instructions.",
-                        genai.types.Part.from_bytes(mime_type="application/pdf", data=pdf_bytes)
-                    ],
-                    config=genai.types.GenerateContentConfig(
-                        system_instruction=self.system_prompt,
-                        temperature=self.temperature
-                    )
+                await asyncio.gather(
+                    self._prepare_stage(client, prepared),
+                    *(self._generate_stage(client, limiter, prepared, generated) for _ in range(MAX_CONCURRENT_SUMMARIES)),
+                    self._note_stage(generated)
+                )
+            finally:
+                # Written once per run, off the event loop: the file can hold hundreds of summaries.
+                await asyncio.get_running_loop().run_in_executor(None, self.pdf_cache.save)
+        self._zotero_executor, self._markdown_executor = None, None
+
+    async def _markdown_to_html(self, text):
+        """Converts Markdown to HTML off the event loop, reusing one configured converter."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._markdown_executor, lambda: self._markdown.reset().convert(text))
+
+    async def _zotero(self, func, *args, **kwargs):
+        """Runs a blocking pyzotero call off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._zotero_executor, functools.partial(func, *args, **kwargs))
+
+    def _local_file_path(self, attachment_key):
+        """Returns the on-disk path of a local attachment, or None if the local server doesn't expose it."""
+        zot = self.zot_local
+        url = f"{zot.endpoint}/{zot.library_type}/{zot.library_id}/items/{attachment_key}/file"
+        # The local API answers with a redirect to a file:// URL inside Zotero's storage directory.
+        response = zot.client.get(url, follow_redirects=False)
+        location = response.headers.get('location', '')
+        if response.is_redirect and location.startswith('file:'):
+            path = url2pathname(urlparse(location).path)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    @contextlib.asynccontextmanager
+    async def _local_pdf(self, pdf_key):
+        """Yields a path to the PDF on disk, downloading it to a temp file only if the storage path is unavailable."""
+        pdf_path = await self._zotero(self._local_file_path, pdf_key)
+        if pdf_path is not None:
+            yield pdf_path
+            return
+        pdf_bytes = await self._zotero(self.zot_local.file, pdf_key)
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+            tmp.write(pdf_bytes)
+        del pdf_bytes
+        try:
+            yield tmp.name
+        finally:
+            os.remove(tmp.name)
+
+    async def _upload_pdf(self, client, pdf_path):
+        """Uploads a PDF to the Gemini Files API and waits until it is ready to use.
+
+        The SDK streams the upload from disk, so the PDF is never held in memory
+        as a single bytes object.
+        """
+        import google.genai as genai
+        uploaded = await client.aio.files.upload(file=pdf_path, config={'mime_type': 'application/pdf'})
+        while uploaded.state == genai.types.FileState.PROCESSING:
+            await asyncio.sleep(2)
+            uploaded = await client.aio.files.get(name=uploaded.name)
+        if uploaded.state == genai.types.FileState.FAILED:
+            raise RuntimeError("Gemini could not process the uploaded PDF.")
+        return uploaded
+
+    async def _ensure_uploaded(self, client, job):
+        """Sets the job's Gemini file URI, reusing a cached upload where possible.
+
+        If Zotero has no MD5 for the PDF, it is hashed here first, which may turn up
+        a cached response that makes the upload unnecessary.
+        """
+        content_hash = job['content_hash']
+        job['pdf_uri'] = self.pdf_cache.get_upload(content_hash) if content_hash else None
+        if job['pdf_uri'] is not None:
+            job['upload_cached'] = True
+            return
+        async with self._local_pdf(job['pdf_key']) as pdf_path:
+            if content_hash is None:
+                loop = asyncio.get_running_loop()
+                content_hash = job['content_hash'] = await loop.run_in_executor(None, file_sha256, pdf_path)
+                job['text'] = self.pdf_cache.get_response(content_hash, self.model, self.temperature, self.system_prompt)
+                job['pdf_uri'] = self.pdf_cache.get_upload(content_hash)
+                job['upload_cached'] = job['pdf_uri'] is not None
+                if job['text'] is not None or job['pdf_uri'] is not None:
+                    return
+            job['pdf_uri'] = (await self._upload_pdf(client, pdf_path)).uri
+            self.pdf_cache.put_upload(content_hash, job['pdf_uri'])
+
+    async def _generate_content(self, client, job, limiter):
+        """Makes one rate-limited generate_content call for the job's uploaded PDF and returns the text."""
+        import google.genai as genai
+        async with limiter:
+            response = await client.aio.models.generate_content(
+                model=self.model,
+                contents=[
+                    "Please analyze the provided research paper and generate notes according to the system instructions.",
+                    genai.types.Part.from_uri(file_uri=job['pdf_uri'], mime_type="application/pdf")
+                ],
+                config=genai.types.GenerateContentConfig(
+                    system_instruction=self.system_prompt,
+                    temperature=self.temperature
                 )
-                
-                raw_markdown_text = response.text
-                html_note_content = markdown.markdown(raw_markdown_text)
-                
-                # --- THIS IS THE CRITICAL FIX ---
-                # Instead of using item_template(), create the dictionary manually.
-                # This guarantees 'itemType' is included.
-                note_to_create = {
-                    'itemType': 'note',
-                    'note': html_note_content,
-                    'tags': [{'tag': 'AI-Summary'}, {'tag': self.model}]
-                }
-                
-                # Pass the manually created dictionary to the create_items method.
-                create_response = self.zot_web.create_items([note_to_create], parentid=item_key)
-                # --- END OF FIX ---
-
-                if create_response['success']:
-                    self.paper_finished.emit(row, "Done")
-                    self.progress.emit(f"Successfully created note for '{item_title}'.")
+            )
+        return response.text
+
+    async def _generate_summary(self, client, job, limiter):
+        """Returns the Markdown summary for a prepared job and caches it."""
+        import google.genai as genai
+        try:
+            text = await self._generate_content(client, job, limiter)
+        except genai.errors.ClientError as e:
+            # A cached upload can be deleted on Gemini's side before it expires here,
+            # or belong to another project; only then re-upload and retry once.
+            if not job['upload_cached'] or e.code not in (403, 404):
+                raise
+            self.pdf_cache.discard_upload(job['content_hash'])
+            self.progress.emit(f"  -> Cached upload of '{job['item_title']}' is no longer available. Uploading again...")
+            async with self._local_pdf(job['pdf_key']) as pdf_path:
+                job['pdf_uri'] = (await self._upload_pdf(client, pdf_path)).uri
+            job['upload_cached'] = False
+            self.pdf_cache.put_upload(job['content_hash'], job['pdf_uri'])
+            text = await self._generate_content(client, job, limiter)
+
+        self.pdf_cache.put_response(job['content_hash'], self.model, self.temperature, self.system_prompt, text)
+        return text
+
+    async def _prepare(self, client, paper_data):
+        """Locates a paper's PDF and gets it onto Gemini. Returns the job, or None if the paper can't be summarized."""
+        row, item = paper_data['row'], paper_data['item']
+        item_key, item_title = item['data']['key'], item['data'].get('title', 'Untitled')
+        job = {'row': row, 'item_key': item_key, 'item_title': item_title, 'pdf_key': None,
+               'content_hash': None, 'pdf_uri': None, 'upload_cached': False, 'text': None}
+
+        self.progress.emit(f"Processing '{item_title}'...")
+        self.paper_finished.emit(row, "Summarizing...")
+
+        try:
+            self.progress.emit(f"  -> Searching for local PDF of '{item_title}' via Zotero server...")
+            children = await self._zotero(self.zot_local.children, item_key)
+            pdf_child = next((c for c in children if is_pdf_attachment(c)), None)
+
+            if not pdf_child:
+                self.paper_finished.emit(row, "Error: PDF not found")
+                self.progress.emit(f"  -> Could not find a local PDF for '{item_title}'.")
+                return None
+
+            job['pdf_key'] = pdf_child['data']['key']
+            # Zotero records an MD5 for stored files, which identifies the PDF without downloading it.
+            md5 = pdf_child['data'].get('md5')
+            job['content_hash'] = f"md5:{md5}" if md5 else None
+            if job['content_hash']:
+                job['text'] = self.pdf_cache.get_response(job['content_hash'], self.model, self.temperature, self.system_prompt)
+            if job['text'] is None:
+                self.progress.emit(f"  -> Found local PDF for '{item_title}'. Uploading to Gemini...")
+                await self._ensure_uploaded(client, job)
+            return job
+
+        except Exception as e:
+            self.paper_finished.emit(row, "Error")
+            self.error.emit(f"An error occurred while processing '{item_title}': {e}")
+            return None
+
+    async def _prepare_stage(self, client, prepared):
+        """Stage 1: prepares papers one at a time and hands them to the generate stage."""
+        try:
+            for paper_data in self.papers:
+                if not self.is_running:
+                    break
+                job = await self._prepare(client, paper_data)
+                if job is not None:
+                    await prepared.put(job)
+        finally:
+            for _ in range(MAX_CONCURRENT_SUMMARIES):
+                await prepared.put(None) # One end marker per generate worker
+
+    async def _generate_stage(self, client, limiter, prepared, generated):
+        """Stage 2: one of several workers sharing the rate limiter to generate summaries."""
+        while (job := await prepared.get()) is not None:
+            if not self.is_running:
+                self.paper_finished.emit(job['row'], "Stopped")
+                continue
+            try:
+                if job['text'] is None:
+                    self.progress.emit(f"  -> Generating summary for '{job['item_title']}'...")
+                    job['text'] = await self._generate_summary(client, job, limiter)
                 else:
-                    self.paper_finished.emit(row, "Failed")
-                    self.progress.emit(f"Failed to create note for '{item_title}': {create_response['failed']}")
+                    self.progress.emit(f"  -> Reusing cached summary for '{job['item_title']}'.")
+                await generated.put(job)
+            except Exception as e:
+                self.paper_finished.emit(job['row'], "Error")
+                self.error.emit(f"An error occurred while processing '{job['item_title']}': {e}")
+        await generated.put(None)
 
+    async def _note_stage(self, generated):
+        """Stage 3: converts summaries to HTML and attaches them to their papers in Zotero.
+
+        Notes are buffered and written in batches of up to NOTE_BATCH_SIZE, flushed when
+        the batch is full, when the oldest note has waited NOTE_FLUSH_INTERVAL seconds,
+        or when generation ends.
+        """
+        loop = asyncio.get_running_loop()
+        pending, flush_deadline = [], None
+        running_generators = MAX_CONCURRENT_SUMMARIES
+        while running_generators:
+            timeout = max(0, flush_deadline - loop.time()) if pending else None
+            try:
+                job = await asyncio.wait_for(generated.get(), timeout)
+            except asyncio.TimeoutError:
+                await self._create_notes(pending)
+                pending = []
+                continue
+            if job is None:
+                running_generators -= 1
+                continue
+            try:
+                html_note_content = await self._markdown_to_html(job['text'])
             except Exception as e:
-                self.paper_finished.emit(row, "Error")
-                self.error.emit(f"An error occurred while processing '{item_title}': {e}")
+                self.paper_finished.emit(job['row'], "Error")
+                self.error.emit(f"An error occurred while processing '{job['item_title']}': {e}")
+                continue
 
-            if i < len(self.papers) - 1 and self.is_running:
-                self.progress.emit("Waiting 6s to respect API rate limit...")
-                self.sleep(6)
-        
-        self.all_finished.emit()
+            # --- THIS IS THE CRITICAL FIX ---
+            # Instead of using item_template(), create the dictionary manually.
+            # This guarantees 'itemType' is included. Setting 'parentItem' directly
+            # lets notes for different papers share one create_items request.
+            note_to_create = {
+                'itemType': 'note',
+                'parentItem': job['item_key'],
+                'note': html_note_content,
+                'tags': [{'tag': AI_SUMMARY_TAG}, {'tag': self.model}]
+            }
+            # --- END OF FIX ---
+
+            pending.append((job, note_to_create))
+            if len(pending) == 1:
+                flush_deadline = loop.time() + NOTE_FLUSH_INTERVAL
+            if len(pending) >= NOTE_BATCH_SIZE:
+                await self._create_notes(pending)
+                pending = []
+        if pending:
+            await self._create_notes(pending)
+
+    async def _create_notes(self, pending):
+        """Creates a batch of notes in a single Zotero request and reports each paper's outcome."""
+        try:
+            create_response = await self._zotero(self.zot_web.create_items, [note for _, note in pending])
+        except Exception as e:
+            for job, _ in pending:
+                self.paper_finished.emit(job['row'], "Error")
+            self.error.emit(f"Failed to create {len(pending)} note(s) in Zotero: {e}")
+            return
+
+        # Zotero reports results keyed by the (stringified) index of each item in the request.
+        for index, (job, _) in enumerate(pending):
+            if str(index) in create_response['success']:
+                self.paper_finished.emit(job['row'], "Done")
+                self.progress.emit(f"Successfully created note for '{job['item_title']}'.")
+            else:
+                self.paper_finished.emit(job['row'], "Failed")
+                self.progress.emit(f"Failed to create note for '{job['item_title']}': {create_response['failed'].get(str(index))}")
 
     def stop(self):
         self.is_running = False
@@ -224,19 +585,59 @@ class CollectionSummaryWorker(QThread):
         super().__init__()
         self.zot = zot_instance
         self.start_collection_key = collection_key
+        self._thread_state = threading.local()
+        self._thread_clients = [] # Every client handed out by _thread_zot, closed after the fetch
+    def _thread_zot(self):
+        """Returns a Zotero client private to the calling pool thread, since pyzotero clients are not thread-safe."""
+        zot = getattr(self._thread_state, 'zot', None)
+        if zot is None:
+            zot = configure_http_client(zotero.Zotero(self.zot.library_id, self.zot.library_type.removesuffix('s'), self.zot.api_key))
+            self._thread_state.zot = zot
+            self._thread_clients.append(zot)
+        return zot
+    def _fetch_biblatex_batch(self, batch_number, chunk_keys):
+        self.progress.emit(f"  -> Fetching BibLaTeX batch {batch_number} ({len(chunk_keys)} items)...")
+        key_string = ",".join(chunk_keys)
+        bib_database = self._thread_zot().items(format='biblatex', itemKey=key_string)
+        if len(chunk_keys) != len(bib_database.entries):
+            self.progress.emit(f"    - Warning: Key count mismatch in batch. Requested {len(chunk_keys)}, got {len(bib_database.entries)}. Some citations may be missing.")
+        # Write the whole batch in one pass, in response order, with a separator that
+        # can't occur in BibTeX so the output splits back into one string per entry.
+        writer = BibTexWriter()
+        writer.contents = ['entries']
+        writer.order_entries_by = None
+        writer.entry_separator = BIBTEX_ENTRY_SEPARATOR
+        bib_strings = writer.write(bib_database).split(BIBTEX_ENTRY_SEPARATOR) if bib_database.entries else []
+        return dict(zip(chunk_keys, bib_strings))
+    def _fetch_children(self, item_key):
+        return self._thread_zot().children(item_key)
+    def _collection_tree(self, collection_key):
+        """Returns the collection and all its descendants, depth-first, walked from one library-wide listing."""
+        all_collections = self.zot.collections()
+        subcollections = defaultdict(list)
+        for coll in all_collections:
+            subcollections[coll['data'].get('parentCollection') or None].append(coll)
+        root = next((c for c in all_collections if c['key'] == collection_key), None)
+        if root is None:
+            raise LookupError(f"Collection '{collection_key}' not found. It may have been deleted; try refreshing the collections.")
+        tree, stack = [], [root]
+        while stack:
+            coll = stack.pop()
+            tree.append(coll)
+            stack.extend(reversed(subcollections[coll['key']]))
+        return tree
     def run(self):
         try:
             self.progress.emit("Fetching collection hierarchy...")
-            collections_to_process = self.zot.all_collections(self.start_collection_key)
+            collections_to_process = self._collection_tree(self.start_collection_key)
             self.progress.emit(f"Found {len(collections_to_process)} collections to process.")
-            all_item_keys, all_items_data = [], {}
+            all_items_data = {} # Insertion-ordered, so the first occurrence of each item wins
             for coll in collections_to_process:
                 self.progress.emit(f"Finding items in: '{coll['data']['name']}'")
                 items = self.zot.collection_items_top(coll['key'])
                 for item in items:
-                    if item['data']['key'] not in all_item_keys:
-                        all_item_keys.append(item['data']['key'])
-                        all_items_data[item['data']['key']] = item
+                    all_items_data.setdefault(item['data']['key'], item)
+            all_item_keys = list(all_items_data)
             if not all_item_keys:
                 self.progress.emit("No items found in the selected collection(s).")
                 self.finished.emit("")
@@ -244,43 +645,58 @@ class CollectionSummaryWorker(QThread):
             self.progress.emit(f"\nFound {len(all_item_keys)} total items. Fetching BibLaTeX citations in batches...")
             all_biblatex_data = {}
             chunk_size = 50
-            for i in range(0, len(all_item_keys), chunk_size):
-                chunk_keys = all_item_keys[i:i + chunk_size]
-                self.progress.emit(f"  -> Fetching BibLaTeX batch {i//chunk_size + 1} ({len(chunk_keys)} items)...")
-                key_string = ",".join(chunk_keys)
-                bib_database = self.zot.items(format='biblatex', itemKey=key_string)
-                if len(chunk_keys) != len(bib_database.entries):
-                    self.progress.emit(f"    - Warning: Key count mismatch in batch. Requested {len(chunk_keys)}, got {len(bib_database.entries)}. Some citations may be missing.")
-                writer = BibTexWriter()
-                for item_key, entry in zip(chunk_keys, bib_database.entries):
-                    temp_db = bibtexparser.bibdatabase.BibDatabase()
-                    temp_db.entries = [entry]
-                    bib_string = writer.write(temp_db)
-                    all_biblatex_data[item_key] = bib_string
+            chunks = [all_item_keys[i:i + chunk_size] for i in range(0, len(all_item_keys), chunk_size)]
+            # Batches and child lookups are independent, so fetch them on a bounded pool;
+            # the pool size caps concurrent requests to stay within Zotero's rate limits.
+            try:
+                with ThreadPoolExecutor(max_workers=ZOTERO_FETCH_WORKERS) as executor:
+                    for biblatex_data in executor.map(self._fetch_biblatex_batch, range(1, len(chunks) + 1), chunks):
+                        all_biblatex_data.update(biblatex_data)
+                    keys_with_biblatex = [key for key in all_item_keys if all_biblatex_data.get(key)]
+                    self.progress.emit(f"\nFetching notes for {len(keys_with_biblatex)} items...")
+                    children_by_key = dict(zip(keys_with_biblatex, executor.map(self._fetch_children, keys_with_biblatex)))
+            finally:
+                # The pool's threads are gone, so release their clients' connection pools.
+                for zot in self._thread_clients:
+                    zot.client.close()
+                self._thread_clients.clear()
             self.progress.emit("\nCompiling final summary document...")
-            all_summary_parts = []
-            for key in all_item_keys:
-                item_title = all_items_data[key]['data'].get('title', 'Untitled')
-                self.progress.emit(f"  -> Processing '{item_title}'")
-                bib_string = all_biblatex_data.get(key)
-                if not bib_string:
-                    self.progress.emit(f"    - Warning: Missing BibLaTeX for key {key}. Skipping.")
-                    continue
-                children = self.zot.children(key)
-                ai_note_content = None
-                for child in children:
-                    if child['data']['itemType'] == 'note':
-                        if 'AI-Summary' in [t.get('tag') for t in child['data'].get('tags', [])]:
-                            ai_note_content = child['data']['note']
-                            self.progress.emit("    - Found AI note.")
-                            break
-                if ai_note_content:
-                    all_summary_parts.append(f"{bib_string.strip()}\n{ai_note_content}")
-                else:
-                    self.progress.emit("    - No AI note found. Using BibLaTeX only.")
-                    all_summary_parts.append(bib_string.strip())
-            final_text = "\n\n**\n\n".join(all_summary_parts)
-            self.finished.emit(final_text)
+            # Stream the document to a temp file part by part instead of holding it all in memory.
+            summary_file = tempfile.NamedTemporaryFile('w', encoding='utf-8', delete=False, suffix='.txt')
+            parts_written = 0
+            try:
+                with summary_file:
+                    for key in all_item_keys:
+                        item_title = all_items_data[key]['data'].get('title', 'Untitled')
+                        self.progress.emit(f"  -> Processing '{item_title}'")
+                        bib_string = all_biblatex_data.get(key)
+                        if not bib_string:
+                            self.progress.emit(f"    - Warning: Missing BibLaTeX for key {key}. Skipping.")
+                            continue
+                        children = children_by_key[key]
+                        ai_note_content = None
+                        for child in children:
+                            if is_ai_note(child):
+                                ai_note_content = child['data']['note']
+                                self.progress.emit("    - Found AI note.")
+                                break
+                        if ai_note_content:
+                            part = f"{bib_string.strip()}\n{ai_note_content}"
+                        else:
+                            self.progress.emit("    - No AI note found. Using BibLaTeX only.")
+                            part = bib_string.strip()
+                        if parts_written:
+                            summary_file.write("\n\n**\n\n")
+                        summary_file.write(part)
+                        parts_written += 1
+            except Exception:
+                os.remove(summary_file.name)
+                raise
+            if not parts_written:
+                os.remove(summary_file.name)
+                self.finished.emit("")
+                return
+            self.finished.emit(summary_file.name)
         except Exception as e:
             self.error.emit(f"Error during collection summary: {e}")
 
@@ -296,7 +712,11 @@ class MainWindow(QMainWindow):
         self.summary_worker, self.collection_summary_worker = None, None
         self.is_task_running = False
 
-        self.settings = load_settings()
+        try:
+            self.settings = load_settings()
+        except SettingsError as e:
+            QMessageBox.warning(self, "Invalid Settings", f"{CONFIG_FILE} could not be loaded and defaults will be used instead: {e}")
+            self.settings = Settings(**DEFAULT_SETTINGS)
 
         self.init_ui()
 
@@ -384,28 +804,26 @@ class MainWindow(QMainWindow):
 
     def check_initial_settings(self):
         """Checks if settings are valid on startup. Forces settings dialog if not."""
-        for key, value in self.settings.items():
-            if "YOUR_" in value:
-                QMessageBox.warning(self, "First-Time Setup", "Please enter your API keys and Zotero information in the settings dialog.")
-                self.open_settings_dialog()
-                # Re-check after user interaction
-                if any("YOUR_" in v for v in self.settings.values()):
-                    self.log("Setup cancelled. Exiting.")
-                    QApplication.instance().quit()
-                    return False
-                break
+        if self.settings.unconfigured_fields():
+            QMessageBox.warning(self, "First-Time Setup", "Please enter your API keys and Zotero information in the settings dialog.")
+            self.open_settings_dialog()
+            # Re-check after user interaction
+            if self.settings.unconfigured_fields():
+                self.log("Setup cancelled. Exiting.")
+                QApplication.instance().quit()
+                return False
         return True
 
     def connect_to_zotero(self):
         self.log("Connecting to Zotero...")
         try:
             # Use loaded settings
-            lib_id = self.settings['zotero_library_id']
-            lib_type = self.settings['zotero_library_type']
-            zot_key = self.settings['zotero_api_key']
+            lib_id = self.settings.zotero_library_id
+            lib_type = self.settings.zotero_library_type
+            zot_key = self.settings.zotero_api_key
 
-            self.zot_web = zotero.Zotero(lib_id, lib_type, zot_key)
-            self.zot_local = zotero.Zotero(lib_id, lib_type, local=True)
+            self.zot_web = CachedZotero(configure_http_client(zotero.Zotero(lib_id, lib_type, zot_key)))
+            self.zot_local = configure_http_client(zotero.Zotero(lib_id, lib_type, local=True))
             
             self.zot_local.collections(limit=1) # Test connection
             self.log("-> Successfully connected to Zotero Web API and Local Server.")
@@ -428,9 +846,10 @@ class MainWindow(QMainWindow):
         self.log(f"Starting summary generation for {len(papers_to_process)} paper(s)...")
         
         # Set Gemini API key for this worker's environment
-        os.environ['GEMINI_API_KEY'] = self.settings['gemini_api_key']
+        os.environ['GEMINI_API_KEY'] = self.settings.gemini_api_key
         
         self.set_task_running(True)
+        self.generate_button.setEnabled(True) # It is the Stop button while the worker runs
         self.generate_button.setText("Stop Generation")
         self.generate_button.clicked.disconnect()
         self.generate_button.clicked.connect(self.stop_summary_generation)
@@ -438,7 +857,7 @@ class MainWindow(QMainWindow):
         self.summary_worker = SummaryWorker(
             self.zot_web, self.zot_local, papers_to_process, 
             self.model_combo.currentText(), self.temp_spinbox.value(),
-            self.settings['gemini_system_prompt']
+            self.settings.gemini_system_prompt
         )
         self.summary_worker.progress.connect(self.log)
         self.summary_worker.paper_finished.connect(self.update_paper_status)
@@ -493,34 +912,43 @@ class MainWindow(QMainWindow):
         self.worker.error.connect(self.handle_error)
         self.worker.start()
     def populate_paper_table(self, papers):
-        self.paper_table.setRowCount(len(papers))
-        for row, paper in enumerate(papers):
-            data = paper['data']
-            title, authors = data.get('title', 'No Title'), ", ".join([f"{c.get('firstName', '')} {c.get('lastName', '')}".strip() for c in data.get('creators', [])])
-            has_pdf, has_ai_note = data.get('has_pdf', False), data.get('has_ai_note', False)
-            check_item, title_item, authors_item = QTableWidgetItem(), QTableWidgetItem(title), QTableWidgetItem(authors)
-            check_item.setFlags(Qt.ItemFlag.ItemIsUserCheckable | Qt.ItemFlag.ItemIsEnabled)
-            check_item.setCheckState(Qt.CheckState.Unchecked)
-            if has_ai_note:
-                status_item = QTableWidgetItem("Done")
-                check_item.setFlags(Qt.ItemFlag.NoItemFlags)
-                done_color = QColor(20, 110, 50)
-                title_item.setForeground(done_color)
-                authors_item.setForeground(done_color)
-                status_item.setForeground(done_color)
-            elif not has_pdf:
-                status_item = QTableWidgetItem("No PDF")
-                check_item.setFlags(Qt.ItemFlag.NoItemFlags)
-                gray_color = QColor(150, 150, 150)
-                title_item.setForeground(gray_color)
-                authors_item.setForeground(gray_color)
-                status_item.setForeground(gray_color)
-            else: status_item = QTableWidgetItem("Pending")
-            title_item.setData(Qt.ItemDataRole.UserRole, paper)
-            self.paper_table.setItem(row, 0, check_item)
-            self.paper_table.setItem(row, 1, title_item)
-            self.paper_table.setItem(row, 2, authors_item)
-            self.paper_table.setItem(row, 3, status_item)
+        # Suspend repaints and signals while filling the table; otherwise every
+        # setItem() call triggers its own layout pass and repaint.
+        self.paper_table.setUpdatesEnabled(False)
+        self.paper_table.blockSignals(True)
+        done_color, gray_color = QColor(20, 110, 50), QColor(150, 150, 150)
+        try:
+            self.paper_table.setRowCount(len(papers))
+            for row, paper in enumerate(papers):
+                data = paper['data']
+                creators = data.get('creators') or ()
+                title = data.get('title', 'No Title')
+                authors = ", ".join(f"{c.get('firstName', '')} {c.get('lastName', '')}".strip() for c in creators if c.get('firstName') or c.get('lastName'))
+                has_pdf, has_ai_note = data.get('has_pdf', False), data.get('has_ai_note', False)
+                check_item, title_item, authors_item = QTableWidgetItem(), QTableWidgetItem(title), QTableWidgetItem(authors)
+                check_item.setFlags(Qt.ItemFlag.ItemIsUserCheckable | Qt.ItemFlag.ItemIsEnabled)
+                check_item.setCheckState(Qt.CheckState.Unchecked)
+                if has_ai_note:
+                    status_item = QTableWidgetItem("Done")
+                    check_item.setFlags(Qt.ItemFlag.NoItemFlags)
+                    title_item.setForeground(done_color)
+                    authors_item.setForeground(done_color)
+                    status_item.setForeground(done_color)
+                elif not has_pdf:
+                    status_item = QTableWidgetItem("No PDF")
+                    check_item.setFlags(Qt.ItemFlag.NoItemFlags)
+                    title_item.setForeground(gray_color)
+                    authors_item.setForeground(gray_color)
+                    status_item.setForeground(gray_color)
+                else: status_item = QTableWidgetItem("Pending")
+                title_item.setData(Qt.ItemDataRole.UserRole, paper)
+                self.paper_table.setItem(row, 0, check_item)
+                self.paper_table.setItem(row, 1, title_item)
+                self.paper_table.setItem(row, 2, authors_item)
+                self.paper_table.setItem(row, 3, status_item)
+        finally:
+            self.paper_table.blockSignals(False)
+            self.paper_table.setUpdatesEnabled(True)
         self.log(f"Loaded {len(papers)} papers.")
     def toggle_all_selection(self, check_state):
         state = Qt.CheckState.Checked if check_state else Qt.CheckState.Unchecked
@@ -529,8 +957,15 @@ class MainWindow(QMainWindow):
             if item.flags() & Qt.ItemFlag.ItemIsUserCheckable:
                 item.setCheckState(state)
     def stop_summary_generation(self):
-        if self.summary_worker: self.summary_worker.stop()
-        self.on_all_summaries_finished()
+        # Papers already being summarized still finish and their notes are saved, so the
+        # controls stay locked until the worker reports all_finished.
+        if self.summary_worker and self.summary_worker.isRunning():
+            self.summary_worker.stop()
+            self.log("Stopping after the papers already in progress...")
+            self.generate_button.setText("Stopping...")
+            self.generate_button.setEnabled(False)
+        else:
+            self.on_all_summaries_finished()
     def on_all_summaries_finished(self):
         self.log("Summary generation finished or was stopped.")
         self.generate_button.setText("Generate Summaries for Selected")
@@ -551,29 +986,37 @@ class MainWindow(QMainWindow):
         self.collection_summary_worker.finished.connect(self.save_collection_summary)
         self.collection_summary_worker.error.connect(self.handle_error)
         self.collection_summary_worker.start()
-    def save_collection_summary(self, summary_text):
+    def save_collection_summary(self, summary_path):
+        """Moves the compiled summary from the worker's temp file to where the user chooses."""
         self.log("Full summary compilation finished.")
         self.set_task_running(False)
-        if not summary_text:
+        if not summary_path:
             QMessageBox.information(self, "No Summaries Found", "No items with an 'AI-Summary' note were found in the selected collection(s).")
             return
         file_path, _ = QFileDialog.getSaveFileName(self, "Save Full Summary", "", "Text Files (*.txt);;All Files (*)")
         if file_path:
             try:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(summary_text)
+                shutil.move(summary_path, file_path)
+                # The temp file was created owner-only; give the saved copy the usual mode for new files.
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(file_path, 0o666 & ~umask)
                 self.log(f"Successfully saved full summary to {file_path}")
                 QMessageBox.information(self, "Success", f"Full summary saved to:\n{file_path}")
             except Exception as e:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(summary_path)
                 self.handle_error(f"Failed to save file: {e}")
-        else: self.log("Save operation cancelled by user.")
+        else:
+            os.remove(summary_path)
+            self.log("Save operation cancelled by user.")
     def handle_error(self, error_message):
         self.log(f"ERROR: {error_message}")
         QMessageBox.critical(self, "An Error Occurred", error_message)
-        if self.is_task_running:
+        # A running SummaryWorker reports per-paper errors and keeps going; it re-enables
+        # the controls itself through all_finished.
+        if self.is_task_running and not (self.summary_worker and self.summary_worker.isRunning()):
             self.set_task_running(False)
-            if self.summary_worker and self.summary_worker.isRunning():
-                self.on_all_summaries_finished()
     def closeEvent(self, event):
         if self.summary_worker and self.summary_worker.isRunning(): self.summary_worker.stop()
         if self.collection_summary_worker and self.collection_summary_worker.isRunning(): self.collection_summary_worker.terminate()
@@ -0,0 +1,75 @@
+import os
+import time
+import hashlib
+
+from json_store import CACHE_DIR, load_json, save_json
+
+# Gemini deletes uploaded files after 48 hours; stop reusing them a little earlier.
+UPLOAD_TTL = 47 * 60 * 60
+MAX_CACHED_RESPONSES = 500
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Hashes a file in 1 MB chunks so it never has to be fully loaded into memory."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+class PdfCache:
+    """Disk cache of Gemini uploads and responses, keyed by PDF content hash.
+
+    Uploads map a content hash to the URI of the file already on Gemini's servers, so
+    re-running a paper skips the download and upload. Uploaded files belong to the
+    API key's project, so upload entries are scoped to a fingerprint of the key. Responses map a content hash plus
+    the generation settings to the returned text, so an identical re-run skips the model
+    call entirely. Changes are kept in memory until save() is called. Not thread-safe;
+    use one instance per worker.
+    """
+
+    def __init__(self, api_key, path=os.path.join(CACHE_DIR, 'pdf_cache.json')):
+        self._path = path
+        self._upload_scope = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+        self._store = load_json(path)
+        self._store.setdefault('uploads', {})
+        self._store.setdefault('responses', {})
+        self._dirty = False
+
+    def get_upload(self, content_hash):
+        entry = self._store['uploads'].get(self._upload_key(content_hash))
+        if entry and entry['expires'] > time.time():
+            return entry['uri']
+        return None
+
+    def put_upload(self, content_hash, uri):
+        self._store['uploads'][self._upload_key(content_hash)] = {'uri': uri, 'expires': time.time() + UPLOAD_TTL}
+        self._store['uploads'] = {k: v for k, v in self._store['uploads'].items() if v['expires'] > time.time()}
+        self._dirty = True
+
+    def discard_upload(self, content_hash):
+        if self._store['uploads'].pop(self._upload_key(content_hash), None):
+            self._dirty = True
+
+    def get_response(self, content_hash, model, temperature, system_prompt):
+        return self._store['responses'].get(self._response_key(content_hash, model, temperature, system_prompt))
+
+    def put_response(self, content_hash, model, temperature, system_prompt, text):
+        responses = self._store['responses']
+        responses[self._response_key(content_hash, model, temperature, system_prompt)] = text
+        while len(responses) > MAX_CACHED_RESPONSES:
+            del responses[next(iter(responses))] # Oldest first
+        self._dirty = True
+
+    def _upload_key(self, content_hash):
+        return f"{self._upload_scope}|{content_hash}"
+
+    @staticmethod
+    def _response_key(content_hash, model, temperature, system_prompt):
+        prompt_hash = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()
+        return f"{content_hash}|{model}|{temperature:.2f}|{prompt_hash}"
+
+    def save(self):
+        """Writes the cache to disk if anything changed since the last save."""
+        if self._dirty:
+            save_json(self._path, self._store)
+            self._dirty = False
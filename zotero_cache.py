@@ -0,0 +1,69 @@
+import os
+import json
+import copy
+import time
+import threading
+
+from json_store import CACHE_DIR, load_json, save_json
+
+# How long a library version fetched from the server is trusted before it is
+# checked again. Keeps back-to-back cached calls from each paying a round trip.
+VERSION_TTL = 5
+
+class CachedZotero:
+    """Thin facade over a pyzotero client that serves listings from a disk cache.
+
+    Each cached listing is stored together with the library's Last-Modified-Version
+    at the time it was fetched, and is reused for as long as the server reports the
+    same version. An unchanged library therefore costs a single one-item request
+    instead of re-downloading every collection and item. Cached methods always
+    return complete (all pages) results. Everything else is delegated to the
+    wrapped client.
+    """
+
+    def __init__(self, zot, cache_dir=CACHE_DIR):
+        self._zot = zot
+        self._path = os.path.join(cache_dir, f"{zot.library_type}_{zot.library_id}.json")
+        self._lock = threading.Lock()
+        self._store = load_json(self._path)
+        self._version, self._version_checked = None, 0.0
+
+    def __getattr__(self, name):
+        return getattr(self._zot, name)
+
+    def collections(self, **kwargs):
+        return self._cached('collections', **kwargs)
+
+    def collection_items(self, collection_key, **kwargs):
+        return self._cached('collection_items', collection_key, **kwargs)
+
+    def collection_items_top(self, collection_key, **kwargs):
+        return self._cached('collection_items_top', collection_key, **kwargs)
+
+    def create_items(self, *args, **kwargs):
+        # Writes bump the library version, so don't trust the remembered one.
+        self._version = None
+        return self._zot.create_items(*args, **kwargs)
+
+    def _library_version(self):
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked > VERSION_TTL:
+            self._version = self._zot.last_modified_version()
+            self._version_checked = now
+        return self._version
+
+    def _cached(self, method, *args, **kwargs):
+        key = json.dumps([method, args, kwargs], sort_keys=True)
+        version = self._library_version()
+        with self._lock:
+            entry = self._store.get(key)
+        if entry and entry['version'] == version:
+            return copy.deepcopy(entry['data'])
+        data = self._zot.everything(getattr(self._zot, method)(*args, **kwargs))
+        with self._lock:
+            # Entries from older library versions can never be served again, so drop
+            # them rather than letting the file grow with every listing ever fetched.
+            self._store = {k: entry for k, entry in self._store.items() if entry['version'] == version}
+            self._store[key] = {'version': version, 'data': copy.deepcopy(data)}
+            save_json(self._path, self._store)
+        return data